@@ -2,11 +2,17 @@ from __future__ import annotations
 
 import asyncio
 import logging
+import sys
 import typing
 import json
 
 import websockets
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
 from CommonClient import CommonContext, gui_enabled, get_base_parser, server_loop, ClientCommandProcessor
 
 from Utils import async_start
@@ -15,6 +21,8 @@ logger = logging.getLogger("Client")
 
 DEBUG = False
 ITEMS_HANDLING = 0b111
+# Triggers waiting on T.I.T.S. beyond this are dropped instead of piling up while it isn't responding
+MAX_QUEUED_TRIGGERS = 256
 
 trigger_ap_receive = "AP-Receive"
 trigger_ap_receive_progression = "AP-Receive-Progression"
@@ -24,6 +32,11 @@ trigger_ap_receive_trap = "AP-Receive-Trap"
 trigger_ap_goal = "AP-Goal"
 trigger_ap_deathlink = "AP-Deathlink"
 
+# orjson is optional; fall back to the stdlib when it isn't installed.
+# Outgoing messages stay str so websockets sends them as text frames.
+_loads = orjson.loads if orjson else json.loads
+_dumps = (lambda obj: orjson.dumps(obj).decode()) if orjson else json.dumps
+
 
 class TitsCommandProcessor(ClientCommandProcessor):
     def __init__(self, ctx: TitsGameContext):
@@ -42,21 +55,22 @@ class TitsCommandProcessor(ClientCommandProcessor):
         """Specifies a name for the API call.
         This only matters if you intend to be running multiple T.I.T.S. applications
         and multiple T.I.T.S. Clients on the same device, and need to differentiate which ones are which."""
-        self.ctx.titsAlias = alias
+        self.ctx.set_tits_alias(alias)
 
     def _cmd_tits_help(self):
         """Provides information about active endpoints and how to connect."""
-        logger.info(f"This client will send the following T.I.T.S. Triggers when connected to a multiworld:")
-        logger.info(f"    - {trigger_ap_receive}:             When receiving any item")
-        logger.info(f"    - {trigger_ap_receive_progression}: When receiving a Progression item")
-        logger.info(f"    - {trigger_ap_receive_useful}:      When receiving a useful item")
-        logger.info(f"    - {trigger_ap_receive_filler}:      When receiving a filler item")
-        logger.info(f"    - {trigger_ap_receive_trap}:        When receiving a Trap")
-        logger.info(f"    - {trigger_ap_goal}:                When completing your goal")
-        logger.info(f"    - {trigger_ap_deathlink}:           When receiving a Death")
-        logger.info("")
-        logger.info(
-            "Any triggers that are not set in T.I.T.S. will be skipped. You need only implement the ones you intend to use")
+        logger.info("\n".join([
+            "This client will send the following T.I.T.S. Triggers when connected to a multiworld:",
+            f"    - {trigger_ap_receive}:             When receiving any item",
+            f"    - {trigger_ap_receive_progression}: When receiving a Progression item",
+            f"    - {trigger_ap_receive_useful}:      When receiving a useful item",
+            f"    - {trigger_ap_receive_filler}:      When receiving a filler item",
+            f"    - {trigger_ap_receive_trap}:        When receiving a Trap",
+            f"    - {trigger_ap_goal}:                When completing your goal",
+            f"    - {trigger_ap_deathlink}:           When receiving a Death",
+            "",
+            "Any triggers that are not set in T.I.T.S. will be skipped. You need only implement the ones you intend to use"
+        ]))
 
 
 async def main(args):
@@ -77,13 +91,22 @@ def launch():
     parser = get_base_parser(description="Gameless Archipelago Client, for throwing things at VTubers.")
     args = parser.parse_args()
     colorama.init()
-    asyncio.run(main(args))
+    # Prefer the libuv based event loop when it's installed, the client is entirely bound on websocket I/O
+    try:
+        if sys.platform == "win32":
+            from winloop import run
+        else:
+            from uvloop import run
+    except ImportError:
+        run = asyncio.run
+    run(main(args))
     colorama.deinit()
 
 
 class TitsGameContext(CommonContext):
     game = ""
     httpServer_task: typing.Optional["asyncio.Task[None]"] = None
+    _writer_task: typing.Optional["asyncio.Task[None]"] = None
     tags = CommonContext.tags | {"TextOnly", "DeathLink"}
     items_handling = 0b111  # receive all items for /received
     want_slot_data = False  # Can't use game specific slot_data
@@ -91,82 +114,177 @@ class TitsGameContext(CommonContext):
     titsPort = 42069
     titsSocket = None
     titsTriggers: typing.Dict[str, str]
+    _trigger_payload: typing.Dict[str, str]
+    _send_queue: typing.Optional[asyncio.Queue[str]] = None
     # The ID passed to the API. Only needs to change if you're controlling multiple TITS clients from the same window
     titsAlias = "AP Tits Client"
 
     def __init__(self, server_address, password):
         super().__init__(server_address, password)
-        self.titsTriggers = dict()
+        self.titsTriggers = {}
+        self._trigger_payload = {}
+        self._dropped_triggers = 0
+        self._goal_fired = False
+        self.build_message_templates()
+
+    def build_message_templates(self):
+        # The request envelope only depends on the alias, so serialize it once instead of on every trigger
+        self._trigger_list_msg = request_trigger_list(self.titsAlias)
+        self._activate_tmpl = activate_trigger_template(self.titsAlias)
+        self._trigger_payload = {name: self._activate_tmpl % _dumps(trigger_id)
+                                 for name, trigger_id in self.titsTriggers.items()}
+
+    def set_tits_alias(self, alias: str):
+        self.titsAlias = alias
+        self.build_message_templates()
 
     def on_print_json(self, args: dict):
         super(TitsGameContext, self).on_print_json(args)
 
+        # Nothing to trigger, don't bother classifying the message
+        if self.titsSocket is None or not self.titsTriggers:
+            return
+
+        msg_type = args.get("type", "")
+
         # If it's an Item and we're receiving it
-        if args.get("type", "") == "ItemSend" and self.slot_concerns_self(args["receiving"]) \
+        if msg_type == "ItemSend" and self.slot_concerns_self(args["receiving"]) \
                 and self.slot_concerns_self(args["item"].player):
-            async_start(self.send_trigger(trigger_ap_receive), name="Sending AP-Receive")
-
-            flags = [part["flags"] for part in args["data"] if "flags" in part]
-            if flags and all(flag == 0b001 for flag in flags):
-                async_start(self.send_trigger(trigger_ap_receive_progression), name="Sending AP-Receive-Progression")
-            if flags and all(flag == 0b010 for flag in flags):
-                async_start(self.send_trigger(trigger_ap_receive_useful), name="Sending AP-Receive-Useful")
-            if flags and all(flag == 0b100 for flag in flags):
-                async_start(self.send_trigger(trigger_ap_receive_trap), name="Sending AP-Receive-Trap")
-            if flags and all(flag == 0 for flag in flags):
-                async_start(self.send_trigger(trigger_ap_receive_filler), name="Sending AP-Receive-Filler")
-
-        # If we just goaled
-        if args.get("type", "") == "Goal" and (
+            triggers = [trigger_ap_receive]
+
+            # Every flagged part has the same flags exactly when the OR and AND of them agree
+            flags_or = 0
+            flags_and = ~0
+            flagged = False
+            for part in args["data"]:
+                flags = part.get("flags")
+                if flags is not None:
+                    flags_or |= flags
+                    flags_and &= flags
+                    flagged = True
+            if flagged and flags_or == flags_and:
+                if flags_or == 0b001:
+                    triggers.append(trigger_ap_receive_progression)
+                elif flags_or == 0b010:
+                    triggers.append(trigger_ap_receive_useful)
+                elif flags_or == 0b100:
+                    triggers.append(trigger_ap_receive_trap)
+                elif flags_or == 0:
+                    triggers.append(trigger_ap_receive_filler)
+            self._queue_triggers(*triggers)
+
+        # If we just goaled, only once per connection in case the message is repeated
+        elif msg_type == "Goal" and not self._goal_fired and (
                 self.slot_concerns_self(args["team"]) or self.slot_concerns_self(args["slot"])):
-            async_start(self.send_trigger(trigger_ap_goal), name="Sending AP-Goal")
+            self._goal_fired = True
+            self._queue_triggers(trigger_ap_goal)
 
     def on_deathlink(self, data: typing.Dict[str, typing.Any]) -> None:
         super().on_deathlink(data)
         logger.info("Deathlink trigger received!")
         # We want to send a deathlink trigger regardless of who died
-        async_start(self.send_trigger(trigger_ap_deathlink), name="Sending AP-Deathlink")
+        self._queue_triggers(trigger_ap_deathlink)
 
     def tits_status(self):
         if self.titsSocket is not None:
-            logger.info(f"T.I.T.S. is connected and listening on port {self.titsSocket.port}")
-            for name, trigger_id in self.titsTriggers.items():
-                logger.info(f"Found Trigger {name}: {trigger_id}")
+            logger.info("\n".join([f"T.I.T.S. is connected and listening on port {self.titsSocket.port}"] +
+                                  [f"Found Trigger {name}: {trigger_id}"
+                                   for name, trigger_id in self.titsTriggers.items()] +
+                                  ([f"Dropped {self._dropped_triggers} triggers while T.I.T.S. wasn't responding"]
+                                   if self._dropped_triggers else [])))
         else:
             logger.info(f"No active connection to T.I.T.S, ensure the program is running and API is enabled, "+
                         "then run /tits_connect to attach")
 
     async def connect_to_api(self, port):
+        # Drop any previous connection first so its writer can't keep sending on the old socket
+        await self._close_tits_connection()
         try:
             self.titsPort = port
             logger.info(f"Connecting to TITS on port {self.titsPort} ")
+            # T.I.T.S. runs locally and only exchanges small JSON messages, so compression is pure overhead
             self.titsSocket = await websockets.connect(f"ws://localhost:{self.titsPort}/websocket",
-                                                       max_size=self.max_size)
+                                                       max_size=self.max_size, compression=None)
             await self.get_trigger_list()
+            self._send_queue = asyncio.Queue(maxsize=MAX_QUEUED_TRIGGERS)
+            self._dropped_triggers = 0
+            self._writer_task = asyncio.create_task(self._writer_loop(self.titsSocket, self._send_queue),
+                                                    name="tits-writer")
 
         except Exception as e:
             print(e)
             logger.info(f"Unable to connect. Ensure T.I.T.S. is running and API is enabled and on port {self.titsPort}")
-            self.titsSocket = None
+            await self._close_tits_connection()
 
     async def get_trigger_list(self):
         if self.titsSocket is not None:
-            await self.titsSocket.send(request_trigger_list(self.titsAlias))
+            await self.titsSocket.send(self._trigger_list_msg)
             result = await self.titsSocket.recv()
-            data = json.loads(result)
+            data = _loads(result)
             # logger.info(result)
             for trigger in data["data"]["triggers"]:
                 logger.info("Found Trigger: " + trigger["name"])
                 self.titsTriggers[trigger["name"]] = trigger["ID"]
-
-    async def send_trigger(self, trigger_name):
-        logger.debug(f"Sending T.I.T.S. Trigger {trigger_name}")
-        if self.titsSocket is not None:
-            if trigger_name in self.titsTriggers:
-                await self.titsSocket.send(activate_trigger(self.titsAlias, self.titsTriggers[trigger_name]))
+                self._trigger_payload[trigger["name"]] = self._activate_tmpl % _dumps(trigger["ID"])
+
+    def _queue_triggers(self, *trigger_names: str):
+        # Payloads are prebuilt per trigger, so the writer task only has to send them
+        if self.titsSocket is None or self._send_queue is None:
+            return
+        for trigger_name in trigger_names:
+            payload = self._trigger_payload.get(trigger_name)
+            if payload is not None:
+                logger.debug(f"Sending T.I.T.S. Trigger {trigger_name}")
+                self._enqueue_send(payload)
             else:
                 logger.debug(f"Skipping sending T.I.T.S. Trigger {trigger_name} since no endpoint was found")
 
+    def _enqueue_send(self, payload: str):
+        try:
+            self._send_queue.put_nowait(payload)
+        except asyncio.QueueFull:
+            self._dropped_triggers += 1
+            logger.debug("Dropping T.I.T.S. Trigger since the send queue is full")
+
+    async def _writer_loop(self, socket, queue: asyncio.Queue[str]):
+        # Single consumer for everything queued by _enqueue_send, stops once the socket is replaced or dropped
+        while self.titsSocket is socket:
+            payload = await queue.get()
+            try:
+                await socket.send(payload)
+            except Exception as e:
+                self._dropped_triggers += 1
+                logger.info(f"Lost connection to T.I.T.S. ({e}), run /tits_connect to reconnect")
+                if self.titsSocket is socket:
+                    self.titsSocket = None
+                    self._send_queue = None
+                await socket.close()
+
+    async def _stop_writer(self):
+        # Never raises, the writer may already have died on a failed send
+        writer_task, self._writer_task = self._writer_task, None
+        if writer_task is not None:
+            writer_task.cancel()
+            try:
+                await writer_task
+            except asyncio.CancelledError:
+                pass
+            except Exception as e:
+                logger.debug(f"T.I.T.S. writer stopped with an error: {e}")
+
+    async def _close_tits_connection(self):
+        # Never raises, so every teardown path finishes resetting the connection state
+        await self._stop_writer()
+        socket, self.titsSocket = self.titsSocket, None
+        self._send_queue = None
+        self.titsTriggers.clear()
+        self._trigger_payload.clear()
+        if socket is not None:
+            try:
+                await socket.close()
+            except Exception as e:
+                logger.debug(f"Error while closing the T.I.T.S. connection: {e}")
+
     def make_gui(self):
         ui = super().make_gui()
 
@@ -193,21 +311,21 @@ class TitsGameContext(CommonContext):
 
     async def disconnect(self, allow_autoreconnect: bool = False):
         self.game = ""
+        self._goal_fired = False
         await super().disconnect(allow_autoreconnect)
 
     async def connection_closed(self):
         await super().connection_closed()
-        await self.titsSocket.close()
+        await self._close_tits_connection()
 
 
 def request_trigger_list(id: str) -> str:
-    return json.dumps({"apiName": "TITSPublicApi", "apiVersion": "1.0", "requestID": id,
-                       "messageType": "TITSTriggerListRequest"})
+    return _dumps({"apiName": "TITSPublicApi", "apiVersion": "1.0", "requestID": id,
+                   "messageType": "TITSTriggerListRequest"})
 
 
-def activate_trigger(id: str, trigger_id: str) -> str:
-    return json.dumps({"apiName": "TITSPublicApi", "apiVersion": "1.0",
-                       "requestID": id, "messageType": "TITSTriggerActivateRequest",
-                       "data": {
-                           "triggerID": trigger_id
-                       }})
+def activate_trigger_template(id: str) -> str:
+    """Returns a TITSTriggerActivateRequest with a %s placeholder for the JSON encoded trigger ID."""
+    envelope = _dumps({"apiName": "TITSPublicApi", "apiVersion": "1.0",
+                       "requestID": id, "messageType": "TITSTriggerActivateRequest"})
+    return envelope[:-1].replace("%", "%%") + ',"data":{"triggerID":%s}}'